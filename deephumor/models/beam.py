@@ -52,6 +52,14 @@ class BeamSearchHelper:
         sample_val = torch.gather(values, 1, indices)
         return sample_val
 
+    def expanded_indices(self):
+        """Returns indices of the sequences repeated by the next `process_logits` step.
+
+        Allows to follow the sampled sequences, e.g. to reorder the decoder states.
+        """
+        n_copies = self._n_copies_has_ended[self.has_ended.long(), :].flatten()
+        return torch.repeat_interleave(torch.arange(len(n_copies), device=self.device), n_copies)
+
     def process_logits(self, logits, sample_seq, sample_val):
         """Main logic of beam search sampling step.
 
@@ -4,7 +4,9 @@ References:
     [1]: "Attention Is All You Need", https://arxiv.org/abs/1706.03762
 """
 import torch
+import torch.nn.functional as F
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 
 from deephumor.models.beam import BeamSearchHelper
 
@@ -12,32 +14,97 @@ from deephumor.models.beam import BeamSearchHelper
 def get_pad_mask(query, key, pad_index=0):
     """Computes padding mask from the Query and Key sequences.
 
+    The mask is broadcast over the query positions by the attention layers.
+
     Args:
         query (torch.Tensor): query sequences of shape `[bs, query_len]`
         key (torch.Tensor): key sequences of shape `[bs, key_len]`
         pad_index (int): index used for padding the values
 
     Returns:
-        torch.Tensor: boolean padding mask of shape `[bs, query_len, key_len]`
+        torch.Tensor: boolean padding mask of shape `[bs, 1, key_len]`
     """
-    bs, seq_len_q = query.shape[:2]
-    bs, seq_len_k = key.shape[:2]
-    pad_mask = (key == pad_index).unsqueeze(1)
-    return pad_mask.expand(bs, seq_len_q, seq_len_k).to(query.device)
+    return (key == pad_index).unsqueeze(1)
+
+
+def _bf16_supported(x):
+    """Checks whether `x` is a CUDA tensor on a device with native BF16 support (Ampere+)."""
+    return x.is_cuda and torch.cuda.get_device_capability(x.device)[0] >= 8
 
 
-def get_autoregressive_mask(seq):
-    """Returns autoregressive mask for the decoder inputs.
+def bf16_autocast(x):
+    """Returns BF16 autocast context for CUDA inputs on devices with native BF16 support (Ampere+).
+
+    Matrix multiplications run in BF16, while autocast keeps softmax and layer normalization in FP32.
+    """
+    return torch.autocast('cuda', dtype=torch.bfloat16, enabled=_bf16_supported(x))
+
+
+def _get_generation_pad_mask(seq, pad_index):
+    """Computes self-attention padding mask of the generated sequences.
+
+    Padded tokens sampled in the middle of the sequences are not attended by the following tokens.
 
     Args:
-        seq (torch.Tensor): input sequences of shape `[bs, seq_len]`
+        seq (torch.Tensor): generated token sequences of shape `[bs, seq_len]`
+        pad_index (int): index used for padding the values
 
     Returns:
-        torch.bool: boolean mask of shape `[bs, seq_len, seq_len]`
+        torch.Tensor: boolean padding mask of shape `[bs, seq_len + 1]` including the starting position,
+            None if there are no padded tokens
     """
-    bs, seq_len = seq.shape[:2]
-    autoregressive_mask = torch.triu(torch.ones([bs, seq_len, seq_len]), 1)
-    return autoregressive_mask.bool().to(seq.device)
+    pad_mask = seq == pad_index
+    if not pad_mask.any():
+        return None
+    return F.pad(pad_mask, (1, 0), value=False)
+
+
+def _repeat_cache(cache, n):
+    """Repeats the key and value caches of the decoder layers for a single sequence `n` times.
+
+    Args:
+        cache (list): key and value caches of the decoder layers for a single sequence
+        n (int): number of the sequences
+
+    Returns:
+        list: key and value caches of the decoder layers for `n` sequences
+    """
+    return [
+        {name: (k.repeat(n, 1, 1, 1), v.repeat(n, 1, 1, 1)) for name, (k, v) in layer_cache.items()}
+        for layer_cache in cache
+    ]
+
+
+def _index_cache(cache, indices):
+    """Selects sequences from the self-attention key and value caches of the decoder layers.
+
+    Other caches (encoder outputs) are the same for all the sequences and are kept as is.
+
+    Args:
+        cache (list): key and value caches of the decoder layers
+        indices (torch.Tensor): indices of the selected sequences of shape `[n,]`
+
+    Returns:
+        list: key and value caches of the decoder layers for `n` sequences
+    """
+    return [
+        {name: (kv[0][indices], kv[1][indices]) if name == 'self' else kv for name, kv in layer_cache.items()}
+        for layer_cache in cache
+    ]
+
+
+def _drop_scale_from_state_dict(state_dict, prefix, *args):
+    """Removes the `scale` parameter stored in older checkpoints."""
+    state_dict.pop(prefix + 'scale', None)
+
+
+def _fuse_qkv_in_state_dict(state_dict, prefix, *args):
+    """Fuses separate `fc_q`, `fc_k` and `fc_v` parameters stored in older checkpoints."""
+    if prefix + 'fc_q.weight' in state_dict:
+        for name in ('weight', 'bias'):
+            state_dict[prefix + 'fc_qkv.' + name] = torch.cat([
+                state_dict.pop(prefix + f'fc_{p}.{name}') for p in 'qkv'
+            ])
 
 
 class MultiHeadAttentionLayer(nn.Module):
@@ -62,10 +129,8 @@ class MultiHeadAttentionLayer(nn.Module):
         self.n_heads = n_heads
         self.head_dim = hid_dim // n_heads
 
-        # query, key and value linear networks
-        self.fc_q = nn.Linear(hid_dim, hid_dim)
-        self.fc_k = nn.Linear(hid_dim, hid_dim)
-        self.fc_v = nn.Linear(hid_dim, hid_dim)
+        # fused query, key and value linear networks
+        self.fc_qkv = nn.Linear(hid_dim, 3 * hid_dim)
 
         # output linear networks
         self.fc_o = nn.Linear(hid_dim, hid_dim)
@@ -73,58 +138,116 @@ class MultiHeadAttentionLayer(nn.Module):
         # attention dropout
         self.dropout = nn.Dropout(dropout)
 
-        # scale parameter
-        self.scale = torch.nn.Parameter(
-            torch.sqrt(torch.tensor(self.head_dim, dtype=torch.float32)),
-            requires_grad=False
-        )
+        # attention is scaled internally by `F.scaled_dot_product_attention`
+        self._register_load_state_dict_pre_hook(_drop_scale_from_state_dict)
+        self._register_load_state_dict_pre_hook(_fuse_qkv_in_state_dict)
+
+    def _in_proj(self, x, start=0, end=3):
+        """Applies blocks `start:end` of the fused Q, K, V linear network and splits them into heads.
 
-    def forward(self, query, key, value, mask=None):
-        """
         Args:
-            query (torch.Tensor): queries of shape `[bs, seq_len, hid_dim]`
-            key (torch.Tensor): keys of shape `[bs, seq_len, hid_dim]`
-            value (torch.Tensor): values of shape `[bs, seq_len, hid_dim]`
-            mask (torch.Tensor): boolean mask for padded elements of shape `[bs, seq_len, seq_len]`
+            x (torch.Tensor): input sequences of shape `[bs, seq_len, hid_dim]`
+            start (int): index of the first block (0 - query, 1 - key, 2 - value)
+            end (int): index of the last block (exclusive)
 
         Returns:
-            torch.Tensor: multi-head attention tensor of shape `[bs, seq_len, hid_dim]`
+            tuple: `end - start` tensors of shape `[bs, n_heads, seq_len, head_dim]`
         """
+        bs, seq_len = x.shape[:2]
+        rows = slice(start * self.hid_dim, end * self.hid_dim)
 
-        bs, seq_len = query.shape[:2]
+        # 2D inputs of shape `[bs * seq_len, hid_dim]` go through the fused GEMM + bias kernel
+        x = F.linear(x.reshape(-1, self.hid_dim), self.fc_qkv.weight[rows], self.fc_qkv.bias[rows])
+        x = x.view(bs, seq_len, end - start, self.n_heads, self.head_dim).permute(2, 0, 3, 1, 4)
 
-        # calculate Q, K, V using corresponding linear networks
-        q, k, v = self.fc_q(query), self.fc_k(key), self.fc_v(value)  # shape is [bs, seq_len, hid_dim]
+        return x.unbind(0)
 
-        # prepare Q, K, V for .matmul() or `@` operator
-        # shape is [bs, n_heads, seq_len, head_dim]
-        q = q.view(bs, seq_len, self.n_heads, self.head_dim).permute(0, 2, 1, 3)
-        k = k.view(bs, seq_len, self.n_heads, self.head_dim).permute(0, 2, 3, 1)
-        v = v.view(bs, seq_len, self.n_heads, self.head_dim).permute(0, 2, 1, 3)
+    def project_kv(self, x):
+        """Computes keys and values of `x`, e.g. to cache encoder outputs during generation.
+
+        Args:
+            x (torch.Tensor): input sequences of shape `[bs, seq_len, hid_dim]`
 
-        # compute energy
-        energy = (q @ k) / self.scale  # shape is [bs, n_heads, seq_q_len, seq_k_len]
+        Returns:
+            tuple: keys and values of shape `[bs, n_heads, seq_len, head_dim]`
+        """
+        return self._in_proj(x, 1, 3)
 
-        if mask is not None:
-            # apply mask
-            mask = mask.unsqueeze(1).repeat(1, self.n_heads, 1, 1)
-            energy = energy.masked_fill(mask, -1e8)
+    def forward(self, query, key, value, mask=None, is_causal=False, kv_cache=None, pos=0):
+        """
+        Args:
+            query (torch.Tensor): queries of shape `[bs, seq_q_len, hid_dim]`
+            key (torch.Tensor): keys of shape `[bs, seq_k_len, hid_dim]`
+            value (torch.Tensor): values of shape `[bs, seq_k_len, hid_dim]`
+            mask (torch.Tensor): boolean mask for padded elements of shape `[bs, seq_q_len, seq_k_len]`
+                or `[bs, 1, seq_k_len]`
+            is_causal (bool): whether to apply autoregressive masking inside the attention kernel
+            kv_cache (tuple, optional): keys and values of shape `[bs, n_heads, max_len, head_dim]`;
+                in self-attention, preallocated buffers which are filled with the keys and values
+                of `query` at positions `pos:pos + seq_q_len` and attended up to the last of them,
+                in encoder-attention, precomputed keys and values of `key` (see `project_kv`)
+            pos (int): position of the first `query` element in the self-attention `kv_cache`
+
+        Returns:
+            torch.Tensor: multi-head attention tensor of shape `[bs, seq_q_len, hid_dim]`
+        """
 
-        # apply softmax along the last dim of energy and get the attention weights
-        # shape is [bs, n_heads, seq_len, seq_len]
-        attention = torch.softmax(energy, dim=-1)
-        attention = self.dropout(attention)
+        bs, seq_len = query.shape[:2]
 
-        # weight values with calculated attention
+        # calculate Q, K, V using the fused linear network
         # shape is [bs, n_heads, seq_len, head_dim]
-        x = attention @ v
+        if query is key and key is value:
+            # self-attention: a single matrix multiplication for Q, K, V
+            q, k, v = self._in_proj(query, 0, 3)
+
+            if kv_cache is not None:
+                # store new keys and values, attend to them and all the previous ones
+                k_cache, v_cache = kv_cache
+                k_cache[:, :, pos:pos + seq_len] = k
+                v_cache[:, :, pos:pos + seq_len] = v
+                k, v = k_cache[:, :, :pos + seq_len], v_cache[:, :, :pos + seq_len]
+        elif key is value:
+            # encoder-attention: a single matrix multiplication for K, V
+            q, = self._in_proj(query, 0, 1)
+            k, v = self._in_proj(key, 1, 3) if kv_cache is None else kv_cache
+        else:
+            assert kv_cache is None, "kv_cache requires the same key and value tensors"
+            q, = self._in_proj(query, 0, 1)
+            k, = self._in_proj(key, 1, 2)
+            v, = self._in_proj(value, 2, 3)
+
+        # explicit mask and `is_causal` can't be combined and `is_causal` is aligned to the first keys,
+        # so causal mask is built explicitly for padded inputs and queries following cached keys
+        seq_len_k = k.shape[2]
+        if is_causal and (mask is not None or seq_len_k != seq_len):
+            is_causal = False
+
+            # a single query attends to all the previous keys
+            if seq_len > 1:
+                causal_mask = torch.ones(seq_len, seq_len_k, dtype=torch.bool, device=k.device)
+                causal_mask = causal_mask.triu(seq_len_k - seq_len + 1).unsqueeze(0)
+                mask = causal_mask if mask is None else mask | causal_mask
+
+        # scaled dot-product attention expects a mask of attended elements,
+        # shape `[bs, 1, seq_q_len, seq_k_len]` is broadcast over the heads
+        attn_mask = None
+        if mask is not None:
+            attn_mask = ~mask.unsqueeze(1)
+
+        # fused QK^T scaling, masking, softmax, dropout and weighting of the values
+        # (dispatches to FlashAttention / memory-efficient kernels when available)
+        # shape is [bs, n_heads, seq_q_len, head_dim]
+        x = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=attn_mask,
+            dropout_p=self.dropout.p if self.training else 0.,
+            is_causal=is_causal
+        )
 
-        # squash 1 and 4 dims back
-        x = x.permute(0, 2, 1, 3).contiguous()
-        x = x.view(bs, -1, self.hid_dim)  # shape is [bs, seq_len, hid_dim]
+        # squash 1 and 4 dims back, copies only if the output strides require it
+        x = x.transpose(1, 2).reshape(-1, self.hid_dim)  # shape is [bs * seq_q_len, hid_dim]
 
         # apply output linear layer
-        x = self.fc_o(x)
+        x = self.fc_o(x).view(bs, seq_len, self.hid_dim)
 
         return x
 
@@ -158,9 +281,12 @@ class PositionwiseFeedforwardLayer(nn.Module):
         Returns:
             torch.Tensor: processed sequences of shape `[bs, seq_len, hid_dim]`
         """
-        # apply linear layers + dropout
+        bs, seq_len, hid_dim = x.shape
+
+        # apply linear layers + dropout over flattened sequences
+        x = x.reshape(-1, hid_dim)
         x = self.dropout(torch.relu(self.fc_1(x)))
-        x = self.fc_2(x)
+        x = self.fc_2(x).view(bs, seq_len, hid_dim)
 
         return x
 
@@ -168,7 +294,7 @@ class PositionwiseFeedforwardLayer(nn.Module):
 class EncoderLayer(nn.Module):
     """Encoder Layer of the Vanilla Transformer."""
 
-    def __init__(self, hid_dim=512, n_heads=8, pf_dim=2048, dropout=0.):
+    def __init__(self, hid_dim=512, n_heads=8, pf_dim=2048, dropout=0., norm_first=False):
         """Initializes EncoderLayer.
 
         Args:
@@ -176,10 +302,14 @@ class EncoderLayer(nn.Module):
             n_heads (int): number of attention heads
             pf_dim (int): dimensions of the position-wise layer
             dropout (float): attention and position-wise layer dropouts
+            norm_first (bool): whether to apply layer normalization before the attention and
+                position-wise feedforward layers (pre-norm) instead of after the residual (post-norm)
         """
 
         super().__init__()
 
+        self.norm_first = norm_first
+
         # self-attention + layer normalization
         self.self_attn = MultiHeadAttentionLayer(hid_dim, n_heads, dropout)
         self.self_attn_ln = nn.LayerNorm(hid_dim)
@@ -195,11 +325,21 @@ class EncoderLayer(nn.Module):
         """
         Args:
             x (torch.Tensor): input sequences of shape `[bs, seq_len, hid_dim]`
-            input_mask (torch.Tensor): boolean mask for padded elements of shape `[bs, seq_len, seq_len]`
+            input_mask (torch.Tensor): boolean mask for padded elements of shape `[bs, 1, seq_len]`
 
         Returns:
             torch.Tensor: processed sequences of shape `[bs, seq_len, hid_dim]`
         """
+        if self.norm_first:
+            # attention layer norm + self-attention + dropout + residual
+            h = self.self_attn_ln(x)
+            x = x + self.dropout(self.self_attn(h, h, h, mask=input_mask))
+
+            # position-wise feedforward layer norm + position-wise feedforward + dropout + residual
+            x = x + self.dropout(self.pf(self.pf_ln(x)))
+
+            return x
+
         ### block 1
         # calculate self-attention + dropout
         attn_out = self.self_attn(x, x, x, mask=input_mask)
@@ -229,7 +369,8 @@ class TransformerEncoder(nn.Module):
     """
 
     def __init__(self, num_tokens, hid_dim=512, n_layers=6, n_heads=8,
-                 pf_dim=2048, dropout=0., pad_index=None, max_len=128):
+                 pf_dim=2048, dropout=0., pad_index=None, max_len=128,
+                 compile_layers=False, use_checkpoint=False, norm_first=False):
         """Initializes TransformerEncoder.
 
         Args:
@@ -241,6 +382,11 @@ class TransformerEncoder(nn.Module):
             dropout (float): attention and position-wise layer dropouts
             pad_index (int): index used for padding values
             max_len (int): maximum lengths of input sequences.
+            compile_layers (bool): whether to compile each layer with `torch.compile`
+                to fuse residual, dropout and layer normalization kernels
+            use_checkpoint (bool): whether to recompute layer activations during the backward pass
+                (gradient checkpointing) instead of storing them in training
+            norm_first (bool): whether to use pre-norm layers, followed by the final layer normalization
         """
 
         super().__init__()
@@ -254,15 +400,23 @@ class TransformerEncoder(nn.Module):
 
         # encoder layers (implemented below)
         self.layers = nn.ModuleList([
-            EncoderLayer(hid_dim, n_heads, pf_dim, dropout)
+            EncoderLayer(hid_dim, n_heads, pf_dim, dropout, norm_first)
             for _ in range(n_layers)
         ])
 
-        # scale parameter
-        self.scale = torch.nn.Parameter(
-            torch.sqrt(torch.tensor(hid_dim, dtype=torch.float32)),
-            requires_grad=False
-        )
+        # final layer normalization of the pre-norm layer outputs
+        self.ln = nn.LayerNorm(hid_dim) if norm_first else nn.Identity()
+
+        # compile layers in-place, parameter names in the state dict stay unchanged
+        if compile_layers:
+            for layer in self.layers:
+                layer.compile()
+
+        self.use_checkpoint = use_checkpoint
+
+        # token embeddings scale
+        self.scale = hid_dim ** -0.5
+        self._register_load_state_dict_pre_hook(_drop_scale_from_state_dict)
 
         # custom weight initialization
         self.init_weights()
@@ -272,6 +426,12 @@ class TransformerEncoder(nn.Module):
             if hasattr(m, 'weight') and m.weight.dim() > 1:
                 nn.init.xavier_uniform_(m.weight.data)
 
+        # initialize fused Q, K, V weights as separate linear networks
+        for m in self.modules():
+            if isinstance(m, MultiHeadAttentionLayer):
+                for w in m.fc_qkv.weight.data.chunk(3):
+                    nn.init.xavier_uniform_(w)
+
     def forward(self, x):
         """
         Args:
@@ -280,30 +440,37 @@ class TransformerEncoder(nn.Module):
         Returns:
             torch.Tensor: encoded sequences of shape `[bs, seq_len, hid_dim]`
         """
-        bs, seq_len = x.shape[:2]
+        seq_len = x.shape[1]
 
-        # get token embeddings and scale with self.scale parameter
-        tok_emb = self.tok_embedding(x) / self.scale
+        # get token embeddings
+        tok_emb = self.tok_embedding(x)
 
-        # get pos embeddings
-        indices = torch.arange(seq_len).repeat(bs, 1).to(x.device)
-        pos_emb = self.pos_embedding(indices)
+        # get pos embeddings of shape `[1, seq_len, hid_dim]` broadcast over the batch,
+        # positions are consecutive, so the first `seq_len` rows are sliced without a gather
+        pos_emb = self.pos_embedding.weight[:seq_len].unsqueeze(0)
 
-        # sum up token and positional embeddings and apply dropout
-        emb = tok_emb + pos_emb
+        # scale token embeddings with self.scale and sum up with positional embeddings
+        # in a single kernel, then apply dropout
+        emb = torch.add(pos_emb, tok_emb, alpha=self.scale)
         emb = self.dropout(emb)
 
-        # compute padding mask
+        # compute padding mask, skipped if there are no padded elements in the batch
         mask = None
-        if self.padding_index is not None:
+        if self.pad_index is not None and (x == self.pad_index).any():
             mask = get_pad_mask(x, x, pad_index=self.pad_index)
 
         # apply encoder layers one by one; input shape is [bs, seq_len, hid dim]
-        x = emb
-        for layer in self.layers:
-            x = layer(x, input_mask=mask)
+        with bf16_autocast(emb):
+            x = emb
+            for layer in self.layers:
+                if self.training and self.use_checkpoint:
+                    x = checkpoint(layer, x, mask, use_reentrant=False)
+                else:
+                    x = layer(x, input_mask=mask)
 
-        return x
+            x = self.ln(x)
+
+        return x.to(emb.dtype)
 
 
 class DecoderLayer(nn.Module):
@@ -313,7 +480,8 @@ class DecoderLayer(nn.Module):
                  hid_dim=512,
                  n_heads=8,
                  pf_dim=2048,
-                 dropout=0.):
+                 dropout=0.,
+                 norm_first=False):
         """Initializes DecoderLayer.
 
         Args:
@@ -321,10 +489,14 @@ class DecoderLayer(nn.Module):
             n_heads (int): number of attention heads
             pf_dim (int): dimensions of the position-wise layer
             dropout (float): attention and position-wise layer dropouts
+            norm_first (bool): whether to apply layer normalization before the attention and
+                position-wise feedforward layers (pre-norm) instead of after the residual (post-norm)
         """
 
         super().__init__()
 
+        self.norm_first = norm_first
+
         # masked self-attention + layer normalization
         self.self_attn = MultiHeadAttentionLayer(hid_dim, n_heads, dropout)
         self.self_attn_ln = nn.LayerNorm(hid_dim)
@@ -340,20 +512,43 @@ class DecoderLayer(nn.Module):
         # attention and position-wise feedforward layer dropouts
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x, enc_out, input_mask=None, enc_mask=None):
+    def forward(self, x, enc_out, input_mask=None, enc_mask=None, cache=None, pos=0):
         """
         Args:
             x (torch.Tensor): input sequences of shape `[bs, seq_len, hid_dim]`
-            enc_out (torch.Tensor): encoder outputs of shape `[bs, seq_len, hid_dim]`
-            input_mask (torch.Tensor): masked self-attention + padding mask of shape `[bs, seq_len, seq_len]`
-            enc_mask  (torch.Tensor): encoder outputs padding mask of shape `[bs, seq_len, seq_len]`
+            enc_out (torch.Tensor): encoder outputs of shape `[bs, enc_seq_len, hid_dim]`
+            input_mask (torch.Tensor, optional): self-attention padding mask of shape `[bs, 1, seq_len]`,
+                autoregressive masking is always applied
+            enc_mask  (torch.Tensor): encoder outputs padding mask of shape `[bs, 1, enc_seq_len]`
+            cache (dict, optional): self-attention (`'self'`) and encoder-attention (`'enc'`) key and value
+                caches used during generation (see `TransformerDecoder.init_cache`)
+            pos (int): position of the first element of `x` in the sequences
 
         Returns:
             torch.Tensor: processed sequences of shape `[bs, seq_len, hid_dim]`
         """
+        kv_cache, enc_kv_cache = (None, None) if cache is None else (cache['self'], cache['enc'])
+
+        if self.norm_first:
+            # attention layer norm + self-attention + dropout + residual
+            h = self.self_attn_ln(x)
+            attn_out = self.self_attn(h, h, h, mask=input_mask, is_causal=True, kv_cache=kv_cache, pos=pos)
+            x = x + self.dropout(attn_out)
+
+            # attention layer norm + encoder-attention + dropout + residual
+            h = self.enc_attn_ln(x)
+            attn_out = self.enc_attn(h, enc_out, enc_out, mask=enc_mask, kv_cache=enc_kv_cache)
+            x = x + self.dropout(attn_out)
+
+            # position-wise feedforward layer norm + position-wise feedforward + dropout + residual
+            x = x + self.dropout(self.pf(self.pf_ln(x)))
+
+            return x
+
         ### block 1
         # self-attention + dropout
-        attn_out = self.self_attn(x, x, x, mask=input_mask)
+        attn_out = self.self_attn(x, x, x, mask=input_mask, is_causal=True,
+                                  kv_cache=kv_cache, pos=pos)
         attn_out = self.dropout(attn_out)
 
         # residual (attention) + attention layer norm
@@ -361,7 +556,7 @@ class DecoderLayer(nn.Module):
 
         ### block 2
         # encoder-attention + dropout
-        attn_out = self.enc_attn(x, enc_out, enc_out, mask=enc_mask)
+        attn_out = self.enc_attn(x, enc_out, enc_out, mask=enc_mask, kv_cache=enc_kv_cache)
         attn_out = self.dropout(attn_out)
 
         # residual (attention) + attention layer norm
@@ -384,6 +579,10 @@ class TransformerDecoder(nn.Module):
 
     Outputs scores for tokens in the target sequence.
 
+    Padded tokens are expected at the end of the input sequences: autoregressive masking
+    alone then keeps them out of the self-attention of the real tokens. Other padded tokens
+    are masked with `key_padding_mask`.
+
     Modifications:
         - Learned positional embeddings instead of the sinusoidal positional encoding.
         - Allows passing as input image embedding vector which is prepended to
@@ -391,7 +590,8 @@ class TransformerDecoder(nn.Module):
     """
 
     def __init__(self, num_tokens, hid_dim=512, n_layers=6, n_heads=8,
-                 pf_dim=2048, dropout=0., pad_index=None, max_len=128):
+                 pf_dim=2048, dropout=0., pad_index=None, max_len=128,
+                 compile_layers=False, use_checkpoint=False, norm_first=False):
         """Initializes TransformerDecoder.
 
         Args:
@@ -403,11 +603,16 @@ class TransformerDecoder(nn.Module):
             dropout (float): attention and position-wise layer dropouts
             pad_index (int): index used for padding values in input sequences
             max_len (int): maximum lengths of input sequences.
+            compile_layers (bool): whether to compile each layer with `torch.compile`
+                to fuse residual, dropout and layer normalization kernels
+            use_checkpoint (bool): whether to recompute layer activations during the backward pass
+                (gradient checkpointing) instead of storing them in training
+            norm_first (bool): whether to use pre-norm layers, followed by the final layer normalization
         """
 
         super().__init__()
 
-        self.pad_index = pad_index  # if None, don't use masking
+        self.pad_index = pad_index  # used for padding generated sequences
 
         # embeddings
         self.tok_embedding = nn.Embedding(num_tokens, hid_dim)
@@ -416,41 +621,75 @@ class TransformerDecoder(nn.Module):
 
         # decoder layers (implemented below)
         self.layers = nn.ModuleList([
-            DecoderLayer(hid_dim, n_heads, pf_dim, dropout)
+            DecoderLayer(hid_dim, n_heads, pf_dim, dropout, norm_first)
             for _ in range(n_layers)
         ])
 
-        # scale parameter
-        self.scale = torch.nn.Parameter(
-            torch.sqrt(torch.tensor(hid_dim, dtype=torch.float32)),
-            requires_grad=False
-        )
+        # final layer normalization of the pre-norm layer outputs
+        self.ln = nn.LayerNorm(hid_dim) if norm_first else nn.Identity()
+
+        # compile layers in-place, parameter names in the state dict stay unchanged
+        if compile_layers:
+            for layer in self.layers:
+                layer.compile()
+
+        self.use_checkpoint = use_checkpoint
+
+        # token embeddings scale
+        self.scale = hid_dim ** -0.5
+        self._register_load_state_dict_pre_hook(_drop_scale_from_state_dict)
 
         # output layer
         self.classifier = nn.Linear(hid_dim, num_tokens)
 
-    def forward(self, x, enc_out, start_emb=None):
+    def init_cache(self, bs, max_len, enc_out):
+        """Allocates key and value caches of the decoder layers for generation.
+
+        Keys and values of the encoder outputs are computed once and stored in the caches.
+        Caches are allocated in BF16 when the decoder runs under `bf16_autocast`.
+
+        Args:
+            bs (int): number of generated sequences
+            max_len (int): maximum length of the sequences including the starting position
+            enc_out (torch.Tensor): encoder outputs of shape `[bs, enc_seq_len, hid_dim]`
+
+        Returns:
+            list: `{'self': (keys, values), 'enc': (keys, values)}` caches for each layer,
+                self-attention caches are of shape `[bs, n_heads, max_len, head_dim]`
+        """
+        weight = self.classifier.weight
+        dtype = torch.bfloat16 if _bf16_supported(weight) else weight.dtype
+        cache = []
+        for layer in self.layers:
+            attn = layer.self_attn
+            shape = (bs, attn.n_heads, max_len, attn.head_dim)
+            with bf16_autocast(enc_out):
+                enc_kv = layer.enc_attn.project_kv(enc_out)
+            cache.append({
+                'self': (weight.new_empty(shape, dtype=dtype), weight.new_empty(shape, dtype=dtype)),
+                'enc': enc_kv
+            })
+        return cache
+
+    def forward(self, x, enc_out, start_emb=None, enc_key_padding_mask=None, cache=None, pos=0,
+                key_padding_mask=None):
         """
         Args:
             x (torch.Tensor): token sequences of shape `[bs, seq_len]`
-            enc_out (torch.Tensor): encoder outputs of shape `[bs, seq_len, hid_dim]`
+            enc_out (torch.Tensor): encoder outputs of shape `[bs, enc_seq_len, hid_dim]`
             start_emb (torch.Tensor, optional): starting position embedding of shape `[bs, hid_dim]`
+            enc_key_padding_mask (torch.Tensor, optional): boolean mask for padded encoder outputs
+                of shape `[bs, enc_seq_len]`, if None, all encoder outputs are attended
+            cache (list, optional): key and value caches of the decoder layers (see `init_cache`),
+                filled with the inputs, so that the next calls process only the new tokens
+            pos (int): position of the first input element in the sequences
+            key_padding_mask (torch.Tensor, optional): boolean mask for padded positions of shape
+                `[bs, pos + seq_len]` including the cached positions, if None, padded tokens
+                are expected at the end of the sequences
 
         Returns:
             torch.Tensor: decoded sequences of shape `[bs, seq_len, num_tokens]`
         """
-        device = x.device
-        bs, dec_seq_len = x.shape[:2]
-        enc_seq_len, hid_dim = enc_out.shape[1:3]
-
-        if start_emb is not None:
-            dec_seq_len += 1
-
-        # pad input and encoder outputs to the same seq_len
-        seq_len = max(dec_seq_len, enc_seq_len)
-        x = torch.cat([x, self.pad_index * torch.ones(bs, seq_len - dec_seq_len).long().to(device)], dim=1)
-        enc_out = torch.cat([enc_out, torch.zeros(bs, seq_len - enc_seq_len, hid_dim).to(device)], dim=1)
-
         # get token embeddings
         tok_emb = self.tok_embedding(x)
 
@@ -458,50 +697,61 @@ class TransformerDecoder(nn.Module):
         if start_emb is not None:
             tok_emb = torch.cat((start_emb.unsqueeze(1), tok_emb), 1)
 
-        # scale token embeddings with self.scale parameter
-        tok_emb = tok_emb / self.scale
+        seq_len = tok_emb.shape[1]
 
-        # get pos embeddings
-        indices = torch.arange(seq_len).repeat(bs, 1).to(device)
-        pos_emb = self.pos_embedding(indices)
+        # get pos embeddings of shape `[1, seq_len, hid_dim]` broadcast over the batch,
+        # positions are consecutive, so `seq_len` rows are sliced without a gather
+        pos_emb = self.pos_embedding.weight[pos:pos + seq_len].unsqueeze(0)
 
-        # sum up token and positional embeddings and apply dropout
-        emb = tok_emb + pos_emb
+        # scale token embeddings with self.scale and sum up with positional embeddings
+        # in a single kernel, then apply dropout
+        emb = torch.add(pos_emb, tok_emb, alpha=self.scale)
         emb = self.dropout(emb)
 
-        # compute decoder input mask
-        if start_emb is not None:
-            x = torch.cat([torch.ones(bs, 1).long().to(device), x], dim=1)
-        pad_mask = get_pad_mask(x, x, pad_index=self.pad_index)
-        autoregr_mask = get_autoregressive_mask(x)
-        input_mask = pad_mask | autoregr_mask
+        # compute decoder input mask, autoregressive masking is applied by the layers
+        input_mask = None
+        if key_padding_mask is not None:
+            input_mask = key_padding_mask.unsqueeze(1)
 
         # compute encoder output mask
-        enc_inp_mask = (enc_out != 0.).all(dim=-1).long()
-        enc_mask = get_pad_mask(x, enc_inp_mask, pad_index=self.pad_index)
-
-        # apply encoder layers one by one; input shape is [bs, seq_len, hid dim]
-        x = emb
-        for layer in self.layers:
-            x = layer(x, enc_out, input_mask=input_mask, enc_mask=enc_mask)
-
-        out = self.classifier(x)
-
-        return out
+        enc_mask = None
+        if enc_key_padding_mask is not None:
+            enc_mask = enc_key_padding_mask.unsqueeze(1)
+
+        # apply decoder layers one by one; input shape is [bs, seq_len, hid dim]
+        # (without the input mask, padded tokens at the end of the sequences are handled
+        # by autoregressive masking)
+        with bf16_autocast(emb):
+            x = emb
+            for i, layer in enumerate(self.layers):
+                layer_cache = None if cache is None else cache[i]
+                if self.training and self.use_checkpoint:
+                    x = checkpoint(layer, x, enc_out, input_mask, enc_mask, use_reentrant=False)
+                else:
+                    x = layer(x, enc_out, input_mask, enc_mask, cache=layer_cache, pos=pos)
+
+            x = self.ln(x)
+            out = self.classifier(x.reshape(-1, x.size(-1)))
+            out = out.view(*x.shape[:2], -1)
+
+        return out.to(emb.dtype)
 
     def generate(self, start_emb, enc_out, caption=None, max_len=25,
-                 temperature=1.0, beam_size=10, top_k=50, eos_index=3):
+                 temperature=1.0, beam_size=10, top_k=50, eos_index=3,
+                 enc_key_padding_mask=None):
         """Generates text tokens based on the image embedding.
 
         Args:
             start_emb (torch.Tensor): starting position embedding of shape `[1, hid_dim]`
-            enc_out (torch.Tensor): encoder outputs of shape `[bs, seq_len, hid_dim]`
+            enc_out (torch.Tensor): encoder outputs of shape `[1, enc_seq_len, hid_dim]`
             caption (torch.Tensor, optional): beginning tokens of the caption of shape `[1, seq_len]`
             max_len (int): maximum length of the caption
             temperature (float): temperature for softmax over logits
             beam_size (int): number of maintained branches at each step
             top_k (int): number of the most probable tokens to consider during sampling
             eos_index (int): index of the EOS (end-of-sequence) token
+            enc_key_padding_mask (torch.Tensor, optional): boolean mask for padded encoder outputs
+                of shape `[1, enc_seq_len]`
 
         Returns:
             torch.Tensor: generated caption tokens of shape `[1, min(output_len, max_len)]`
@@ -524,8 +774,12 @@ class TransformerDecoder(nn.Module):
             pos = caption.size(1)
             sample_seq[:, :pos] = caption
 
+        # key and value caches for the starting position and `max_len` tokens
+        cache = self.init_cache(1, max_len + 1, enc_out)
+
         # run TransformerDecoder over the inputs and predict the next token
-        outputs = self(sample_seq, enc_out, start_emb)
+        outputs = self(sample_seq[:, :pos], enc_out, start_emb, enc_key_padding_mask, cache=cache,
+                       key_padding_mask=_get_generation_pad_mask(sample_seq[:, :pos], self.pad_index))
         logits = outputs[:, pos, :]
 
         # filter `top_k` values
@@ -540,14 +794,21 @@ class TransformerDecoder(nn.Module):
         sample_seq = sample_seq.repeat(beam_size, 1)
         sample_seq[:, pos:pos + 1] = sample_ind
 
-        # repeat `image_emb` and `enc_out`
-        enc_out = enc_out.repeat(beam_size, 1, 1)
-        start_emb = start_emb.repeat(beam_size, 1)
+        # repeat the mask of `enc_out` and caches, the layers read keys and values
+        # of `enc_out` from the caches, so `enc_out` itself isn't repeated
+        if enc_key_padding_mask is not None:
+            enc_key_padding_mask = enc_key_padding_mask.repeat(beam_size, 1)
+        cache = _repeat_cache(cache, beam_size)
 
         for i in range(pos + 1, max_len + 1):
-            # predict the next time step
-            outputs = self(sample_seq, enc_out, start_emb)
-            logits = outputs[:, i, :]
+            # predict the next time step, only the last token is processed
+            pad_mask = _get_generation_pad_mask(sample_seq[:, :i], self.pad_index)
+            outputs = self(sample_seq[:, i - 1:i], enc_out, None, enc_key_padding_mask, cache=cache, pos=i,
+                           key_padding_mask=pad_mask)
+            logits = outputs[:, -1, :]
+
+            # indices of the sequences in candidate sequences
+            cand_cache_ind = helper.expanded_indices()
 
             (prev_seqs, prev_vals), (new_ind, new_val) = helper.process_logits(
                 logits, sample_seq, sample_val
@@ -561,9 +822,10 @@ class TransformerDecoder(nn.Module):
             # sample `beam` sequences
             filter_ind = helper.sample_k_indices(cand_val, k=beam_size)
 
-            # update total sequences and their scores
+            # update total sequences, their scores and caches
             sample_val = cand_val[filter_ind]
             sample_seq = cand_seq[filter_ind]
+            cache = _index_cache(cache, cand_cache_ind[filter_ind])
 
             # filter `has_ended` flags
             helper.has_ended = helper.has_ended[filter_ind]
@@ -586,7 +848,8 @@ class SelfAttentionDecoderLayer(nn.Module):
                  hid_dim=512,
                  n_heads=8,
                  pf_dim=2048,
-                 dropout=0.):
+                 dropout=0.,
+                 norm_first=False):
         """Initializes SelfAttentionDecoderLayer.
 
         Args:
@@ -594,10 +857,14 @@ class SelfAttentionDecoderLayer(nn.Module):
             n_heads (int): number of attention heads
             pf_dim (int): dimensions of the position-wise layer
             dropout (float): attention and position-wise layer dropouts
+            norm_first (bool): whether to apply layer normalization before the attention and
+                position-wise feedforward layers (pre-norm) instead of after the residual (post-norm)
         """
 
         super().__init__()
 
+        self.norm_first = norm_first
+
         # masked self-attention + layer normalization
         self.self_attn = MultiHeadAttentionLayer(hid_dim, n_heads, dropout)
         self.self_attn_ln = nn.LayerNorm(hid_dim)
@@ -609,18 +876,36 @@ class SelfAttentionDecoderLayer(nn.Module):
         # attention and position-wise feedforward layer dropouts
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x, input_mask=None):
+    def forward(self, x, input_mask=None, cache=None, pos=0):
         """
         Args:
             x (torch.Tensor): input sequences of shape `[bs, seq_len, hid_dim]`
-            input_mask (torch.Tensor): masked self-attention + padding mask of shape `[bs, seq_len, seq_len]`
+            input_mask (torch.Tensor, optional): self-attention padding mask of shape `[bs, 1, seq_len]`,
+                autoregressive masking is always applied
+            cache (dict, optional): self-attention (`'self'`) key and value caches used during generation
+                (see `SelfAttentionTransformerDecoder.init_cache`)
+            pos (int): position of the first element of `x` in the sequences
 
         Returns:
             torch.Tensor: processed sequences of shape `[bs, seq_len, hid_dim]`
         """
+        kv_cache = None if cache is None else cache['self']
+
+        if self.norm_first:
+            # attention layer norm + self-attention + dropout + residual
+            h = self.self_attn_ln(x)
+            attn_out = self.self_attn(h, h, h, mask=input_mask, is_causal=True, kv_cache=kv_cache, pos=pos)
+            x = x + self.dropout(attn_out)
+
+            # position-wise feedforward layer norm + position-wise feedforward + dropout + residual
+            x = x + self.dropout(self.pf(self.pf_ln(x)))
+
+            return x
+
         ### block 1
         # self-attention + dropout
-        attn_out = self.self_attn(x, x, x, mask=input_mask)
+        attn_out = self.self_attn(x, x, x, mask=input_mask, is_causal=True,
+                                  kv_cache=kv_cache, pos=pos)
         attn_out = self.dropout(attn_out)
 
         # residual (attention) + attention layer norm
@@ -646,6 +931,10 @@ class SelfAttentionTransformerDecoder(nn.Module):
 
     Outputs scores for tokens in the target sequence.
 
+    Padded tokens are expected at the end of the input sequences: autoregressive masking
+    alone then keeps them out of the self-attention of the real tokens. Other padded tokens
+    are masked with `key_padding_mask`.
+
     Modifications:
         - No encoder outputs as inputs as in a classical Transformer Decoder.
         - Learned positional embeddings instead of the sinusoidal positional encoding.
@@ -653,7 +942,8 @@ class SelfAttentionTransformerDecoder(nn.Module):
     """
 
     def __init__(self, num_tokens, hid_dim=512, n_layers=6, n_heads=8,
-                 pf_dim=2048, dropout=0., pad_index=None, max_len=128):
+                 pf_dim=2048, dropout=0., pad_index=None, max_len=128,
+                 compile_layers=False, use_checkpoint=False, norm_first=False):
         """Initializes TransformerImageDecoder.
 
         Args:
@@ -665,11 +955,16 @@ class SelfAttentionTransformerDecoder(nn.Module):
             dropout (float): attention and position-wise layer dropouts
             pad_index (int): index used for padding values in input sequences
             max_len (int): maximum lengths of input sequences.
+            compile_layers (bool): whether to compile each layer with `torch.compile`
+                to fuse residual, dropout and layer normalization kernels
+            use_checkpoint (bool): whether to recompute layer activations during the backward pass
+                (gradient checkpointing) instead of storing them in training
+            norm_first (bool): whether to use pre-norm layers, followed by the final layer normalization
         """
 
         super().__init__()
 
-        self.pad_index = pad_index  # if None, don't use masking
+        self.pad_index = pad_index  # used for padding generated sequences
 
         # embeddings
         self.tok_embedding = nn.Embedding(num_tokens, hid_dim)
@@ -678,30 +973,65 @@ class SelfAttentionTransformerDecoder(nn.Module):
 
         # decoder layers (implemented below)
         self.layers = nn.ModuleList([
-            SelfAttentionDecoderLayer(hid_dim, n_heads, pf_dim, dropout)
+            SelfAttentionDecoderLayer(hid_dim, n_heads, pf_dim, dropout, norm_first)
             for _ in range(n_layers)
         ])
 
-        # scale parameter
-        self.scale = torch.nn.Parameter(
-            torch.sqrt(torch.tensor(hid_dim, dtype=torch.float32)),
-            requires_grad=False
-        )
+        # final layer normalization of the pre-norm layer outputs
+        self.ln = nn.LayerNorm(hid_dim) if norm_first else nn.Identity()
+
+        # compile layers in-place, parameter names in the state dict stay unchanged
+        if compile_layers:
+            for layer in self.layers:
+                layer.compile()
+
+        self.use_checkpoint = use_checkpoint
+
+        # token embeddings scale
+        self.scale = hid_dim ** -0.5
+        self._register_load_state_dict_pre_hook(_drop_scale_from_state_dict)
 
         # output layer
         self.classifier = nn.Linear(hid_dim, num_tokens)
 
-    def forward(self, x, start_emb):
+    def init_cache(self, bs, max_len):
+        """Allocates key and value caches of the decoder layers for generation.
+
+        Caches are allocated in BF16 when the decoder runs under `bf16_autocast`.
+
+        Args:
+            bs (int): number of generated sequences
+            max_len (int): maximum length of the sequences including the starting position
+
+        Returns:
+            list: `{'self': (keys, values)}` caches of shape `[bs, n_heads, max_len, head_dim]` for each layer
+        """
+        weight = self.classifier.weight
+        dtype = torch.bfloat16 if _bf16_supported(weight) else weight.dtype
+        cache = []
+        for layer in self.layers:
+            attn = layer.self_attn
+            shape = (bs, attn.n_heads, max_len, attn.head_dim)
+            cache.append({
+                'self': (weight.new_empty(shape, dtype=dtype), weight.new_empty(shape, dtype=dtype))
+            })
+        return cache
+
+    def forward(self, x, start_emb, cache=None, pos=0, key_padding_mask=None):
         """
         Args:
             x (torch.Tensor): token sequences of shape `[bs, seq_len]`
             start_emb (torch.Tensor, optional): starting position embedding of shape `[bs, hid_dim]`
+            cache (list, optional): key and value caches of the decoder layers (see `init_cache`),
+                filled with the inputs, so that the next calls process only the new tokens
+            pos (int): position of the first input element in the sequences
+            key_padding_mask (torch.Tensor, optional): boolean mask for padded positions of shape
+                `[bs, pos + seq_len]` including the cached positions, if None, padded tokens
+                are expected at the end of the sequences
 
         Returns:
             torch.Tensor: decoded sequences of shape `[bs, seq_len, num_tokens]`
         """
-        device = x.device
-
         # get token embeddings
         tok_emb = self.tok_embedding(x)
 
@@ -709,33 +1039,39 @@ class SelfAttentionTransformerDecoder(nn.Module):
         if start_emb is not None:
             tok_emb = torch.cat((start_emb.unsqueeze(1), tok_emb), 1)
 
-        # scale token embeddings with self.scale parameter
-        tok_emb = tok_emb / self.scale
-        bs, seq_len = tok_emb.shape[:2]
+        seq_len = tok_emb.shape[1]
 
-        # get pos embeddings
-        indices = torch.arange(seq_len).repeat(bs, 1).to(device)
-        pos_emb = self.pos_embedding(indices)
+        # get pos embeddings of shape `[1, seq_len, hid_dim]` broadcast over the batch,
+        # positions are consecutive, so `seq_len` rows are sliced without a gather
+        pos_emb = self.pos_embedding.weight[pos:pos + seq_len].unsqueeze(0)
 
-        # sum up token and positional embeddings and apply dropout
-        emb = tok_emb + pos_emb
+        # scale token embeddings with self.scale and sum up with positional embeddings
+        # in a single kernel, then apply dropout
+        emb = torch.add(pos_emb, tok_emb, alpha=self.scale)
         emb = self.dropout(emb)
 
-        # compute decoder input mask
-        if start_emb is not None:
-            x = torch.cat([torch.ones(bs, 1).long().to(device), x], dim=1)
-        pad_mask = get_pad_mask(x, x, pad_index=self.pad_index)
-        autoregr_mask = get_autoregressive_mask(x)
-        input_mask = pad_mask | autoregr_mask
-
-        # apply encoder layers one by one; input shape is [bs, seq_len, hid dim]
-        x = emb
-        for layer in self.layers:
-            x = layer(x, input_mask=input_mask)
-
-        out = self.classifier(x)
-
-        return out
+        # compute decoder input mask, autoregressive masking is applied by the layers
+        input_mask = None
+        if key_padding_mask is not None:
+            input_mask = key_padding_mask.unsqueeze(1)
+
+        # apply decoder layers one by one; input shape is [bs, seq_len, hid dim]
+        # (without the input mask, padded tokens at the end of the sequences are handled
+        # by autoregressive masking)
+        with bf16_autocast(emb):
+            x = emb
+            for i, layer in enumerate(self.layers):
+                layer_cache = None if cache is None else cache[i]
+                if self.training and self.use_checkpoint:
+                    x = checkpoint(layer, x, input_mask, use_reentrant=False)
+                else:
+                    x = layer(x, input_mask, cache=layer_cache, pos=pos)
+
+            x = self.ln(x)
+            out = self.classifier(x.reshape(-1, x.size(-1)))
+            out = out.view(*x.shape[:2], -1)
+
+        return out.to(emb.dtype)
 
     def generate(self, start_emb, caption=None, max_len=25,
                  temperature=1.0, beam_size=10, top_k=50, eos_index=3):
@@ -771,8 +1107,12 @@ class SelfAttentionTransformerDecoder(nn.Module):
             pos = caption.size(1)
             sample_seq[:, :pos] = caption
 
+        # key and value caches for the starting position and `max_len` tokens
+        cache = self.init_cache(1, max_len + 1)
+
         # run TransformerDecoder over the inputs and predict the next token
-        outputs = self(sample_seq, start_emb)
+        outputs = self(sample_seq[:, :pos], start_emb, cache=cache,
+                       key_padding_mask=_get_generation_pad_mask(sample_seq[:, :pos], self.pad_index))
         logits = outputs[:, pos, :]
 
         # filter `top_k` values
@@ -787,13 +1127,17 @@ class SelfAttentionTransformerDecoder(nn.Module):
         sample_seq = sample_seq.repeat(beam_size, 1)
         sample_seq[:, pos:pos + 1] = sample_ind
 
-        # repeat `image_emb` and `enc_out`
-        start_emb = start_emb.repeat(beam_size, 1)
+        # repeat caches
+        cache = _repeat_cache(cache, beam_size)
 
         for i in range(pos + 1, max_len + 1):
-            # predict the next time step
-            outputs = self(sample_seq, start_emb)
-            logits = outputs[:, i, :]
+            # predict the next time step, only the last token is processed
+            pad_mask = _get_generation_pad_mask(sample_seq[:, :i], self.pad_index)
+            outputs = self(sample_seq[:, i - 1:i], None, cache=cache, pos=i, key_padding_mask=pad_mask)
+            logits = outputs[:, -1, :]
+
+            # indices of the sequences in candidate sequences
+            cand_cache_ind = helper.expanded_indices()
 
             (prev_seqs, prev_vals), (new_ind, new_val) = helper.process_logits(
                 logits, sample_seq, sample_val
@@ -807,9 +1151,10 @@ class SelfAttentionTransformerDecoder(nn.Module):
             # sample `beam` sequences
             filter_ind = helper.sample_k_indices(cand_val, k=beam_size)
 
-            # update total sequences and their scores
+            # update total sequences, their scores and caches
             sample_val = cand_val[filter_ind]
             sample_seq = cand_seq[filter_ind]
+            cache = _index_cache(cache, cand_cache_ind[filter_ind])
 
             # filter `has_ended` flags
             helper.has_ended = helper.has_ended[filter_ind]